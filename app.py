@@ -1,136 +1,610 @@
 from flask import Flask, render_template, render_template_string, request, jsonify, send_file
-from datetime import datetime, timedelta
-import json
+from flask.json.provider import DefaultJSONProvider
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+import functools
+import hashlib
+import hmac
+import orjson
 import os
 import logging
-import csv
+import time
+import queue
+import re
+import sqlite3
+import atexit
+import threading
+from collections import defaultdict
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that serializes jsonify() responses with orjson"""
+    
+    def _option(self, indent=False):
+        option = orjson.OPT_PASSTHROUGH_DATETIME  # keep Flask's HTTP-date format for dates
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._option(bool(kwargs.get('indent')))).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Same as DefaultJSONProvider.response, but without the bytes -> str -> bytes round-trip
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = orjson.dumps(obj, default=self.default, option=self._option(indent))
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json_provider_class = OrjsonProvider
+app.json = OrjsonProvider(app)
+# Behind a proxy that honours X-Sendfile, let it serve file downloads from disk
+app.use_x_sendfile = os.getenv('TECHCAFE_X_SENDFILE', '0') == '1'
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Debug mode (development server only). With it on, Werkzeug's reloader runs
+# this module twice: a parent that only watches files and restarts a child
+# (WERKZEUG_RUN_MAIN=true) that serves requests. Only the child may own the
+# bookings on disk.
+DEBUG = os.getenv('TECHCAFE_DEBUG', '0') == '1'
+_RELOADER_PARENT = __name__ == '__main__' and DEBUG and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+
 # Admin password configuration
 ADMIN_PASSWORD = os.getenv('TECHCAFE_ADMIN_PASSWORD', 'Nomura2025!')
+# hmac.compare_digest only accepts ASCII str, so compare UTF-8 bytes
+_ADMIN_PASSWORD_BYTES = ADMIN_PASSWORD.encode('utf-8')
+
+# Ordinary user cancellations are not written to the CSV unless this is set;
+# admin "completed" cancellations always are
+EXTRACT_ALL_CANCELS = os.getenv('TECHCAFE_EXTRACT_ALL_CANCELS', '0') == '1'
 
-# Persistent storage for bookings using JSON file
+# Persistent storage for bookings: a JSON snapshot plus an append-only log of
+# mutations since that snapshot (one JSON line per put/del). On disk bookings
+# are keyed by "YYYY-MM-DD_HH:MM"; in memory they are nested by date.
 BOOKINGS_FILE = 'bookings.json'
+BOOKINGS_LOG = 'bookings.log'
+SNAPSHOT_EVERY_OPS = 100       # rewrite the snapshot after this many logged mutations...
+SNAPSHOT_EVERY_SECONDS = 300   # ...or once this much time has passed since the last one
+
+# Bookings for past dates are moved out of memory (and out of the snapshot)
+# into this SQLite archive, so both stay proportional to upcoming bookings
+ARCHIVE_DB = 'bookings.db'
+
+@dataclass(init=False)
+class Booking:
+    """A single booked slot (orjson serializes it like the old dict)"""
+    # Slots by hand: dataclass(slots=True) needs Python 3.10+, and a class-level
+    # default for kiosk would clash with its slot, hence the explicit __init__
+    __slots__ = ('username', 'device_id', 'booked_at', 'kiosk')
+    username: str
+    device_id: str
+    booked_at: str
+    kiosk: bool
+    
+    def __init__(self, username, device_id, booked_at, kiosk=False):
+        self.username = username
+        self.device_id = device_id
+        self.booked_at = booked_at
+        self.kiosk = kiosk
+
+# date -> time -> Booking. Once the server is running, a date's inner dict is
+# never mutated in place: writers build a new one and swap it in (see
+# _put_booking/_remove_booking), so readers can use it without locking.
 bookings = {}
 
+# One lock per date guards check-and-mutate on that date's bookings. Mutations
+# are also queued for persistence while holding it, so the log sees them in order.
+_date_locks = defaultdict(threading.Lock)
+
+# Per-date mutation counters, bumped after each swap. Together with a per-process
+# boot id they form the /get_bookings ETag.
+_date_versions = defaultdict(int)
+_BOOT_ID = format(time.time_ns(), 'x')
+
+# False until load_bookings succeeds; until then nothing may overwrite the
+# snapshot or truncate the log, or a failed load would erase them
+_bookings_loaded = False
+
+_log_file = None
+_ops_since_snapshot = 0
+_last_snapshot = time.monotonic()
+
+def _put_booking(date_str, time_str, booking):
+    """Add a booking by replacing the date's dict with an updated copy
+
+    Must be called with _date_locks[date_str] held.
+    """
+    date_bookings = dict(bookings.get(date_str, {}))
+    date_bookings[time_str] = booking
+    bookings[date_str] = date_bookings
+    _date_versions[date_str] += 1
+
+def _remove_booking(date_str, time_str):
+    """Remove a booking by replacing the date's dict with an updated copy
+
+    Must be called with _date_locks[date_str] held.
+    """
+    date_bookings = dict(bookings.get(date_str, {}))
+    date_bookings.pop(time_str, None)
+    bookings[date_str] = date_bookings
+    _date_versions[date_str] += 1
+
+_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+_TIME_RE = re.compile(r'\d{2}:\d{2}')
+
+def is_valid_slot(date_str, time_str):
+    """Whether date_str/time_str look like YYYY-MM-DD and HH:MM"""
+    return (isinstance(date_str, str) and isinstance(time_str, str) and
+            _DATE_RE.fullmatch(date_str) is not None and _TIME_RE.fullmatch(time_str) is not None)
+
+def _slot_key(date_str, time_str):
+    """Build the persisted "date_time" key for a slot"""
+    return f"{date_str}_{time_str}"
+
+def _parse_slot_key(slot_key):
+    """Split a persisted "date_time" key into (date, time), raising ValueError if malformed"""
+    if not isinstance(slot_key, str):
+        raise ValueError(f"malformed slot key {slot_key!r}")
+    date_str, sep, time_str = slot_key.partition('_')
+    if not sep or not is_valid_slot(date_str, time_str):
+        raise ValueError(f"malformed slot key {slot_key!r}")
+    return date_str, time_str
+
+def _unflatten_bookings(flat):
+    """Convert persisted {"date_time": booking} into {date: {time: booking}}
+
+    Malformed entries are skipped (and logged) so one bad record can't fail the whole load.
+    """
+    nested = {}
+    for slot_key, booking in flat.items():
+        try:
+            date_str, time_str = _parse_slot_key(slot_key)
+            nested.setdefault(date_str, {})[time_str] = Booking(**booking)
+        except (TypeError, ValueError) as e:
+            logger.warning("Skipping unreadable booking in %s: %s", BOOKINGS_FILE, e)
+    return nested
+
+def _flatten_bookings():
+    """Convert bookings into the persisted {"date_time": booking} form"""
+    # list() each level first: request threads may add/remove keys while we iterate
+    return {
+        _slot_key(date_str, time_str): booking
+        for date_str, date_bookings in list(bookings.items())
+        for time_str, booking in list(date_bookings.items())
+    }
+
+def replay_bookings_log():
+    """Apply the mutations logged since the last snapshot to bookings"""
+    global _ops_since_snapshot
+    if not os.path.exists(BOOKINGS_LOG):
+        return
+    replayed = 0
+    with open(BOOKINGS_LOG, 'rb') as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                # A torn final line from a crash mid-write; everything before it is intact
+                logger.warning("Skipping unreadable line in %s", BOOKINGS_LOG)
+                continue
+            try:
+                date_str, time_str = _parse_slot_key(entry['key'])
+                if entry['op'] == 'put':
+                    bookings.setdefault(date_str, {})[time_str] = Booking(**entry['val'])
+                else:
+                    bookings.get(date_str, {}).pop(time_str, None)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Skipping unreadable entry in %s: %s", BOOKINGS_LOG, e)
+                continue
+            replayed += 1
+    _ops_since_snapshot = replayed
+    logger.info("Replayed %d operations from %s", replayed, BOOKINGS_LOG)
+
 def load_bookings():
-    """Load bookings from JSON file"""
-    global bookings
+    """Load bookings from the JSON snapshot, then replay the mutation log"""
+    global bookings, _bookings_loaded
     try:
         if os.path.exists(BOOKINGS_FILE):
-            with open(BOOKINGS_FILE, 'r', encoding='utf-8') as f:
-                bookings = json.load(f)
-            logger.info(f"Loaded {len(bookings)} bookings from {BOOKINGS_FILE}")
+            with open(BOOKINGS_FILE, 'rb') as f:
+                flat = orjson.loads(f.read())
+            bookings = _unflatten_bookings(flat)
+            logger.info("Loaded %d bookings from %s", len(flat), BOOKINGS_FILE)
         else:
             bookings = {}
             logger.info("No existing bookings file found, starting with empty bookings")
+        replay_bookings_log()
+        _bookings_loaded = True
     except Exception as e:
-        logger.error(f"Error loading bookings: {e}")
+        logger.error("Error loading bookings: %s; %s and %s will not be overwritten", e, BOOKINGS_FILE, BOOKINGS_LOG)
         bookings = {}
+        _bookings_loaded = False
 
-def save_bookings():
-    """Save bookings to JSON file"""
+def init_archive():
+    """Create the SQLite archive table if it doesn't exist yet"""
+    with sqlite3.connect(ARCHIVE_DB) as conn:
+        # The (date, time) primary key also serves date-only lookups
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bookings_archive ("
+            "date TEXT NOT NULL, time TEXT NOT NULL, username TEXT NOT NULL, "
+            "device_id TEXT NOT NULL, booked_at TEXT NOT NULL, kiosk INTEGER NOT NULL, "
+            "PRIMARY KEY (date, time))"
+        )
+    conn.close()
+
+def is_past_date(date_str):
+    """Whether date_str (YYYY-MM-DD) is before today"""
+    return date_str < date.today().isoformat()
+
+def archive_past_bookings():
+    """Move bookings for dates before today from memory into the SQLite archive
+
+    Returns the number of bookings archived.
+    """
+    past_dates = [date_str for date_str in list(bookings) if is_past_date(date_str)]
+    if not past_dates:
+        return 0
+    archived = 0
     try:
-        with open(BOOKINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(bookings, f, indent=2, ensure_ascii=False)
-        logger.info(f"Saved {len(bookings)} bookings to {BOOKINGS_FILE}")
+        with sqlite3.connect(ARCHIVE_DB) as conn:
+            for date_str in past_dates:
+                with _date_locks[date_str]:
+                    rows = [
+                        (date_str, time_str, b.username, b.device_id, b.booked_at, b.kiosk)
+                        for time_str, b in bookings[date_str].items()
+                    ]
+                    # OR IGNORE: an archived record is final. A row can only already exist
+                    # if a previous archive run committed but crashed before its snapshot.
+                    inserted = conn.executemany("INSERT OR IGNORE INTO bookings_archive VALUES (?, ?, ?, ?, ?, ?)", rows).rowcount
+                    conn.commit()
+                    if inserted != len(rows):
+                        logger.warning("%d booking(s) for %s were already archived; kept the archived records",
+                                       len(rows) - inserted, date_str)
+                    del bookings[date_str]
+                # The date's lock stays in _date_locks: another thread may hold or be
+                # waiting on it, and a fresh lock would no longer serialize with it
+                archived += len(rows)
+        conn.close()
+        logger.info("Archived %d bookings from %d past date(s) to %s", archived, len(past_dates), ARCHIVE_DB)
     except Exception as e:
-        logger.error(f"Error saving bookings: {e}")
+        logger.error("Error archiving past bookings: %s", e)
+    return archived
 
-def extract_booking_to_csv(slot_key, booking, reason="completed"):
-    """Extract a single booking to CSV file (append to date-specific file)"""
+def get_archived_bookings(date_str):
+    """Return {time: Booking} for a past date from the SQLite archive"""
+    if not is_past_date(date_str):
+        return {}
     try:
-        # Parse slot_key to get date and time
-        date_str, time_str = slot_key.split('_')
-        
-        # Create filename with just date
-        filename = f"bookings_{date_str}.csv"
-        
-        # Check if file exists to determine if we need to write header
-        file_exists = os.path.exists(filename)
-        
-        # Append to CSV file
-        with open(filename, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            
-            # Write header only if file doesn't exist
-            if not file_exists:
-                writer.writerow(['Date', 'Time', 'Booked By', 'Device ID', 'Booked At', 'Updated At', 'Reason', 'Kiosk'])
-            
-            # Write data
-            writer.writerow([
-                date_str,
-                time_str,
-                booking.get('username', ''),
-                booking.get('device_id', ''),
-                booking.get('booked_at', ''),
-                datetime.now().isoformat(),
-                reason,
-                'yes' if booking.get('kiosk') else 'no'
-            ])
-        
-        logger.info(f"Extracted booking {slot_key} to {filename}")
-        return {'success': True, 'filename': filename}
+        with sqlite3.connect(ARCHIVE_DB) as conn:
+            rows = conn.execute(
+                "SELECT time, username, device_id, booked_at, kiosk FROM bookings_archive WHERE date = ?",
+                (date_str,)
+            ).fetchall()
+        conn.close()
+    except Exception as e:
+        logger.error("Error reading archived bookings: %s", e)
+        return {}
+    return {time_str: Booking(username, device_id, booked_at, bool(kiosk))
+            for time_str, username, device_id, booked_at, kiosk in rows}
+
+def save_bookings():
+    """Write a full snapshot of bookings to the JSON file and truncate the mutation log"""
+    global _log_file, _ops_since_snapshot, _last_snapshot
+    if not _bookings_loaded:
+        # Snapshotting would replace the unloaded data with whatever is in memory
+        logger.error("Bookings failed to load; not writing a snapshot over %s", BOOKINGS_FILE)
+        return
+    try:
+        archive_past_bookings()
+        flat = _flatten_bookings()
+        tmp_file = BOOKINGS_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(orjson.dumps(flat))
+        os.replace(tmp_file, BOOKINGS_FILE)
         
+        # The snapshot now covers everything in the log
+        if _log_file is not None:
+            _log_file.close()
+        _log_file = open(BOOKINGS_LOG, 'wb')
+        _ops_since_snapshot = 0
+        _last_snapshot = time.monotonic()
+        logger.info("Saved %d bookings to %s", len(flat), BOOKINGS_FILE)
     except Exception as e:
-        logger.error(f"Error extracting booking to CSV: {e}")
-        return {'success': False, 'error': str(e)}
+        logger.error("Error saving bookings: %s", e)
+
+def snapshot_if_needed():
+    """Rewrite the snapshot once enough mutations or time have accumulated"""
+    if not _bookings_loaded:
+        return
+    if (_ops_since_snapshot >= SNAPSHOT_EVERY_OPS or
+            time.monotonic() - _last_snapshot >= SNAPSHOT_EVERY_SECONDS):
+        save_bookings()
+
+def append_op(op, date_str, time_str, booking=None):
+    """Record a single booking mutation ('put' or 'del') in the append-only log
+
+    The line is buffered; the writer thread flushes once per batch.
+    """
+    global _log_file, _ops_since_snapshot
+    try:
+        if _log_file is None:
+            _log_file = open(BOOKINGS_LOG, 'ab')
+        entry = {'op': op, 'key': _slot_key(date_str, time_str)}
+        if op == 'put':
+            entry['val'] = booking
+        _log_file.write(orjson.dumps(entry) + b'\n')
+        _ops_since_snapshot += 1
+    except Exception as e:
+        logger.error("Error logging booking operation: %s", e)
+
+CSV_BUFFER_SIZE = 64 * 1024
+
+CSV_HEADER = ['Date', 'Time', 'Booked By', 'Device ID', 'Booked At', 'Updated At', 'Reason', 'Kiosk']
+
+# Characters that force a CSV field to be quoted (same rule as csv.writer's default dialect)
+_CSV_SPECIAL = frozenset(',"\r\n')
+
+def _csv_field(value):
+    """Format one CSV field, quoting it only if it contains a special character"""
+    value = str(value)
+    if _CSV_SPECIAL.isdisjoint(value):
+        return value
+    return '"' + value.replace('"', '""') + '"'
+
+def _csv_line(fields):
+    """Format a CSV line the way csv.writer would, including its CRLF terminator"""
+    return ','.join(map(_csv_field, fields)) + '\r\n'
+
+# Open CSV files keyed by filename, reused across writes
+_csv_files = {}
+_csv_lock = threading.Lock()
+
+def _get_csv_file(filename):
+    """Return the cached file for filename, opening it if needed
+
+    Must be called with _csv_lock held.
+    """
+    f = _csv_files.get(filename)
+    if f is None:
+        # Rows are flushed explicitly per batch, so a large buffer just saves syscalls
+        f = open(filename, 'a', buffering=CSV_BUFFER_SIZE, newline='', encoding='utf-8')
+        
+        # Write header only if the file is new/empty
+        if f.tell() == 0:
+            f.write(_csv_line(CSV_HEADER))
+        _csv_files[filename] = f
+    return f
+
+def close_csv_file(filename):
+    """Close the cached handle for filename (e.g. before the file is deleted)
+
+    Must be called with _csv_lock held.
+    """
+    f = _csv_files.pop(filename, None)
+    if f is not None:
+        f.close()
+
+def close_past_csv_files():
+    """Close cached handles for CSV files of dates before today"""
+    # Filenames embed ISO dates, so they sort chronologically
+    cutoff = csv_filename_for(date.today().isoformat())
+    with _csv_lock:
+        for filename in [filename for filename in _csv_files if filename < cutoff]:
+            close_csv_file(filename)
+
+def close_csv_files():
+    """Close all cached CSV handles"""
+    with _csv_lock:
+        for f in _csv_files.values():
+            f.close()
+        _csv_files.clear()
+
+atexit.register(close_csv_files)
+
+def _csv_row(date_str, time_str, booking, reason, updated_at):
+    """Build the CSV line for a booking"""
+    return _csv_line([
+        date_str,
+        time_str,
+        booking.username,
+        booking.device_id,
+        booking.booked_at,
+        updated_at,
+        reason,
+        'yes' if booking.kiosk else 'no'
+    ])
+
+def extract_bookings_to_csv(items):
+    """Extract several bookings to CSV at once
+
+    items is an iterable of (date_str, time_str, booking, reason). Rows are grouped by
+    date file so each file is written and flushed once. Returns {filename: error},
+    where error is None if that file's rows were written.
+    """
+    rows_by_file = defaultdict(list)
+    # One "Updated At" timestamp for the whole batch
+    updated_at = datetime.now().isoformat()
+    for date_str, time_str, booking, reason in items:
+        rows_by_file[csv_filename_for(date_str)].append(_csv_row(date_str, time_str, booking, reason, updated_at))
+    
+    results = {}
+    with _csv_lock:
+        for filename, rows in rows_by_file.items():
+            try:
+                f = _get_csv_file(filename)
+                f.write(''.join(rows))
+                f.flush()
+                results[filename] = None
+                logger.debug("Extracted %d booking(s) to %s", len(rows), filename)
+            except Exception as e:
+                results[filename] = str(e)
+                logger.error("Error extracting bookings to %s: %s", filename, e)
+    return results
+
+def extract_booking_to_csv(date_str, time_str, booking, reason="completed"):
+    """Extract a single booking to its date's CSV file right away (bypassing the write queue)"""
+    filename = csv_filename_for(date_str)
+    error = extract_bookings_to_csv([(date_str, time_str, booking, reason)])[filename]
+    if error is not None:
+        return {'success': False, 'error': error}
+    return {'success': True, 'filename': filename}
 
+def csv_filename_for(date_str):
+    """Name of the CSV file that collects extracted bookings for a date"""
+    return f"bookings_{date_str}.csv"
 
-# Load existing bookings on startup
-load_bookings()
+_CSV_FILENAME_RE = re.compile(r'bookings_\d{4}-\d{2}-\d{2}\.csv')
+
+def is_booking_csv(filename):
+    """Whether filename is a bookings_YYYY-MM-DD.csv file name (no path parts)"""
+    return _CSV_FILENAME_RE.fullmatch(filename) is not None
+
+
+# Disk writes (log appends, snapshots, CSV extraction) are done by a single
+# background thread so request handlers only update memory and enqueue.
+WRITE_BATCH_SIZE = 64
+write_queue = queue.Queue()
+
+def queue_booking_op(op, date_str, time_str, booking=None):
+    """Queue a booking mutation for the append-only log"""
+    write_queue.put(('booking', op, date_str, time_str, booking))
+
+def queue_csv_extract(date_str, time_str, booking, reason):
+    """Queue a booking for extraction to its date's CSV file"""
+    write_queue.put(('csv', date_str, time_str, booking, reason))
+
+def _apply_writes(batch):
+    """Perform a batch of queued writes, flushing each file once at the end"""
+    csv_items = []
+    for item in batch:
+        if item[0] == 'booking':
+            _, op, date_str, time_str, booking = item
+            append_op(op, date_str, time_str, booking)
+        else:
+            csv_items.append(item[1:])
+    if csv_items:
+        extract_bookings_to_csv(csv_items)
+    close_past_csv_files()
+    if _log_file is not None:
+        _log_file.flush()
+    snapshot_if_needed()
+
+def _writer_loop():
+    """Drain write_queue forever, coalescing bursts into batches"""
+    while True:
+        batch = [write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _apply_writes(batch)
+        except Exception as e:
+            logger.error("Error applying queued writes: %s", e)
+        finally:
+            for _ in batch:
+                write_queue.task_done()
+
+_writer_thread = threading.Thread(target=_writer_loop, name='booking-writer', daemon=True)
+
+def _save_on_exit():
+    """Take the shutdown snapshot, but only if this process logged any mutations
+
+    A process that never served a request (e.g. the dev reloader's parent) would
+    otherwise overwrite the serving process's data with its startup-time state.
+    """
+    if _ops_since_snapshot:
+        save_bookings()
+
+def start_bookings():
+    """Load bookings and start the background writer in the process that serves requests"""
+    # Load existing bookings on startup, moving any that are already past into the archive
+    init_archive()
+    load_bookings()
+    if any(is_past_date(date_str) for date_str in bookings):
+        save_bookings()
+    
+    _writer_thread.start()
+    # The writer is a daemon thread; make sure nothing queued is lost on exit, then
+    # take a final snapshot so the next start doesn't have to replay the log
+    # (atexit runs handlers in reverse, so the join happens first)
+    atexit.register(_save_on_exit)
+    atexit.register(write_queue.join)
+
+# The reloader parent never serves a request, so it must not archive, snapshot
+# or start a writer of its own
+if not _RELOADER_PARENT:
+    start_bookings()
 
 # Load display names from file (cached in memory for performance)
 display_names = []
 
+# Pre-serialized /get_names response body and its ETag, rebuilt on every load.
+# Kept as one tuple so readers never pair one load's body with another's ETag.
+_names_cache = (b'', '')
+
+def set_display_names(names):
+    """Replace display_names and rebuild the cached /get_names payload"""
+    global display_names, _names_cache
+    display_names = names
+    payload = orjson.dumps({'success': True, 'names': display_names})
+    _names_cache = (payload, hashlib.md5(payload).hexdigest())
+
+def parse_display_names(text):
+    """Split display_name.txt content into names (one per line, blanks skipped)"""
+    return [name for name in map(str.strip, text.splitlines()) if name]
+
 def load_display_names():
     """Load display names from display_name.txt file"""
-    global display_names
     try:
         with open('display_name.txt', 'r', encoding='utf-8') as f:
-            display_names = [line.strip() for line in f.readlines() if line.strip()]
-        logger.info(f"Loaded {len(display_names)} display names")
+            names = parse_display_names(f.read())
+        logger.info("Loaded %d display names", len(names))
     except FileNotFoundError:
         logger.warning("display_name.txt not found, using empty list")
-        display_names = []
+        names = []
     except Exception as e:
-        logger.error(f"Error loading display names: {e}")
-        display_names = []
+        logger.error("Error loading display names: %s", e)
+        names = []
+    set_display_names(names)
 
 # Load names at startup
 load_display_names()
 
 
+def _build_time_slots():
+    """Generate time slots from 09:00 to 18:00 with 15-minute intervals, excluding lunch hours (12:00-14:00)
+
+    Returns (all_slots, morning_slots, afternoon_slots).
+    """
+    def slots(start_hour, end_hour):
+        return [f"{mins // 60:02d}:{mins % 60:02d}" for mins in range(start_hour * 60, end_hour * 60, 15)]
+    
+    # Morning slots (09:00-12:00) and afternoon slots (14:00-18:00)
+    morning_slots = slots(9, 12)
+    afternoon_slots = slots(14, 18)
+    
+    return morning_slots + afternoon_slots, morning_slots, afternoon_slots
+
+# Time slots never change, so build them once at import
+TIME_SLOTS, MORNING_SLOTS, AFTERNOON_SLOTS = (tuple(group) for group in _build_time_slots())
+
 def get_time_slots():
-    """Generate time slots from 09:00 to 18:00 with 15-minute intervals, excluding lunch hours (12:00-14:00)"""
-    slots = []
-    start_time = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
-    lunch_start = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
-    lunch_end = datetime.now().replace(hour=14, minute=0, second=0, microsecond=0)
-    end_time = datetime.now().replace(hour=18, minute=0, second=0, microsecond=0)
-    
-    # Morning slots (09:00-12:00)
-    current_time = start_time
-    while current_time < lunch_start:
-        slots.append(current_time.strftime("%H:%M"))
-        current_time += timedelta(minutes=15)
-    
-    # Afternoon slots (14:00-18:00)
-    current_time = lunch_end
-    while current_time < end_time:
-        slots.append(current_time.strftime("%H:%M"))
-        current_time += timedelta(minutes=15)
-    
-    return slots
+    """Return the precomputed time slots"""
+    return TIME_SLOTS
 
-def get_available_dates():
-    """Get next 3 business days, skipping weekends (including today if it's a weekend)"""
-    today = datetime.now().date()
+@functools.lru_cache(maxsize=4)
+def _dates_for(today_ordinal):
+    """Build the available dates list for the given day (memoized per day)"""
+    today = date.fromordinal(today_ordinal)
     dates = []
     current_date = today
     days_added = 0
@@ -151,122 +625,156 @@ def get_available_dates():
     
     return dates
 
+def get_available_dates():
+    """Get next 3 business days, skipping weekends (including today if it's a weekend)"""
+    return _dates_for(date.today().toordinal())
+
+# Rendered index.html keyed by day ordinal; the page only depends on the date
+_index_cache = {}
+
 @app.route('/')
 def index():
-    # Check if it's a mobile device
-    user_agent = request.headers.get('User-Agent', '').lower()
-    is_mobile = any(device in user_agent for device in ['iphone', 'ipad', 'android', 'mobile'])
+    global _index_cache
+    today = date.today().toordinal()
+    html = _index_cache.get(today)
     
-    time_slots = get_time_slots()
-    morning_slots = [slot for slot in time_slots if 9 <= int(slot.split(':')[0]) < 12]
-    afternoon_slots = [slot for slot in time_slots if 14 <= int(slot.split(':')[0]) < 18]
+    # Always re-render in debug mode so template edits show up immediately
+    if html is None or app.debug:
+        html = render_template('index.html', 
+                             time_slots=TIME_SLOTS,
+                             morning_slots=MORNING_SLOTS,
+                             afternoon_slots=AFTERNOON_SLOTS,
+                             dates=_dates_for(today))
+        # Replacing the dict drops the previous day's page
+        _index_cache = {today: html}
     
-    return render_template('index.html', 
-                         time_slots=time_slots,
-                         morning_slots=morning_slots,
-                         afternoon_slots=afternoon_slots,
-                         dates=get_available_dates())
+    return html
 
 @app.route('/book', methods=['POST'])
 def book_slot():
     data = request.get_json()
-    date = data.get('date')
-    time = data.get('time')
+    date_str = data.get('date')
+    time_str = data.get('time')
     username = data.get('username')
     device_id = data.get('device_id')
     kiosk = bool(data.get('kiosk', False))
     
-    if not all([date, time, device_id]) or username is None:
+    if not all([date_str, time_str, device_id]) or username is None:
         return jsonify({'success': False, 'message': 'Missing required fields'})
     
+    if not is_valid_slot(date_str, time_str):
+        return jsonify({'success': False, 'message': 'Invalid date or time'})
     
-    slot_key = f"{date}_{time}"
-    
-    if slot_key in bookings:
-        return jsonify({'success': False, 'message': 'Slot already booked'})
-    
-    bookings[slot_key] = {
-        'username': username,
-        'device_id': device_id,
-        'booked_at': datetime.now().isoformat(),
-        'kiosk': kiosk
-    }
+    # Check-then-set under the date's lock so two clients can't both take the slot
+    with _date_locks[date_str]:
+        # Past dates are (or are about to be) archived and are read-only
+        if is_past_date(date_str):
+            return jsonify({'success': False, 'message': 'Cannot book a past date'})
+        
+        if time_str in bookings.get(date_str, {}):
+            return jsonify({'success': False, 'message': 'Slot already booked'})
     
-    # Extract booking to CSV for logging
-    booking = bookings[slot_key]
-    csv_result = extract_booking_to_csv(slot_key, booking, "booked")
+        booking = Booking(username, device_id, datetime.now().isoformat(), kiosk)
+        _put_booking(date_str, time_str, booking)
     
-    # Save to file
-    save_bookings()
+        # Extract booking to CSV for logging and persist it (both in the background)
+        queue_csv_extract(date_str, time_str, booking, "booked")
+        queue_booking_op('put', date_str, time_str, booking)
     
     return jsonify({'success': True, 'message': 'Booking confirmed'})
 
 @app.route('/cancel', methods=['POST'])
 def cancel_booking():
     data = request.get_json()
-    date = data.get('date')
-    time = data.get('time')
+    date_str = data.get('date')
+    time_str = data.get('time')
     device_id = data.get('device_id')
     is_admin = data.get('is_admin', False)
     reason = data.get('reason', 'cancelled')  # Default to 'cancelled', can be 'completed' for admin
     
-    if not all([date, time, device_id]):
+    if not all([date_str, time_str, device_id]):
         return jsonify({'success': False, 'message': 'Missing required fields'})
     
-    slot_key = f"{date}_{time}"
+    if not is_valid_slot(date_str, time_str):
+        return jsonify({'success': False, 'message': 'Invalid date or time'})
     
-    if slot_key not in bookings:
-        return jsonify({'success': False, 'message': 'No booking found for this slot'})
+    with _date_locks[date_str]:
+        if is_past_date(date_str):
+            return jsonify({'success': False, 'message': 'Bookings for past dates cannot be changed'})
+        
+        booking = bookings.get(date_str, {}).get(time_str)
     
-    # If the booking was made in kiosk mode, only admin can cancel
-    if bookings[slot_key].get('kiosk') and not is_admin:
-        return jsonify({'success': False, 'message': 'Kiosk bookings can only be cancelled by admin'})
-
-    # Otherwise, require same-device or admin
-    if bookings[slot_key]['device_id'] != device_id and not is_admin:
-        return jsonify({'success': False, 'message': 'You can only cancel your own bookings'})
+        if booking is None:
+            return jsonify({'success': False, 'message': 'No booking found for this slot'})
     
-    # Extract booking to CSV before deleting
-    booking = bookings[slot_key]
-    csv_result = extract_booking_to_csv(slot_key, booking, reason)
+        # If the booking was made in kiosk mode, only admin can cancel
+        if booking.kiosk and not is_admin:
+            return jsonify({'success': False, 'message': 'Kiosk bookings can only be cancelled by admin'})
+
+        # Otherwise, require same-device or admin
+        if booking.device_id != device_id and not is_admin:
+            return jsonify({'success': False, 'message': 'You can only cancel your own bookings'})
     
-    # Delete the booking
-    del bookings[slot_key]
+        # Extract booking to CSV before deleting
+        csv_extracted = reason == 'completed' or EXTRACT_ALL_CANCELS
+        if csv_extracted:
+            queue_csv_extract(date_str, time_str, booking, reason)
     
-    # Save to file
-    save_bookings()
+        # Delete the booking
+        _remove_booking(date_str, time_str)
     
-    # Return success with CSV extraction info
-    response = {'success': True, 'message': 'Booking cancelled'}
-    if csv_result['success']:
-        response['csv_extracted'] = True
-        response['csv_filename'] = csv_result['filename']
-    else:
-        response['csv_extracted'] = False
-        response['csv_error'] = csv_result['error']
+        # Persist the deletion
+        queue_booking_op('del', date_str, time_str)
     
-    return jsonify(response)
+    # Return success with CSV extraction info if it was extracted (the write
+    # itself happens in the background; failures are logged by the writer thread)
+    result = {'success': True, 'message': 'Booking cancelled'}
+    if csv_extracted:
+        result['csv_extracted'] = True
+        result['csv_filename'] = csv_filename_for(date_str)
+    return jsonify(result)
 
 @app.route('/get_bookings', methods=['GET', 'POST'])
 def get_bookings():
     # Try to get date from both args and form data
-    date = request.args.get('date') or request.form.get('date')
+    date_str = request.args.get('date') or request.form.get('date')
     
-    if not date:
+    if not date_str:
         return jsonify({'success': False, 'message': 'Date required'})
     
-    date_bookings = {}
-    for slot_key, booking in bookings.items():
-        if slot_key.startswith(date):
-            time = slot_key.split('_')[1]
-            date_bookings[time] = booking
-    
-    return jsonify({'success': True, 'bookings': date_bookings})
+    # Read the version before the data: a concurrent write can then only pair
+    # newer data with an older tag (refetched next poll), never the reverse
+    etag = f"{_BOOT_ID}-{_date_versions.get(date_str, 0)}"
+    if request.method == 'GET' and etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        date_bookings = bookings.get(date_str)
+        if date_bookings is None:
+            date_bookings = get_archived_bookings(date_str)
+        response = jsonify({'success': True, 'bookings': date_bookings})
+    response.set_etag(etag)
+    # Bookings change at any time, so clients must always revalidate
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/get_bookings_bulk', methods=['GET'])
+def get_bookings_bulk():
+    """API endpoint to get bookings for all currently visible dates in one request"""
+    dates = get_available_dates()
+    return jsonify({
+        'success': True,
+        'bookings': {d['date']: bookings.get(d['date'], {}) for d in dates}
+    })
 
 @app.route('/get_names', methods=['GET'])
 def get_names():
     """API endpoint to get all display names for type-ahead functionality"""
-    return jsonify({'success': True, 'names': display_names})
+    payload, etag = _names_cache
+    response = app.response_class(payload, mimetype='application/json')
+    response.set_etag(etag)
+    # Names change on admin upload, so let clients cache but always revalidate (304)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/get_current_dates', methods=['GET'])
 def get_current_dates():
@@ -274,20 +782,29 @@ def get_current_dates():
     dates = get_available_dates()
     return jsonify({'success': True, 'dates': dates})
 
+# (epoch second, body) of the last /get_current_time response; the payload only
+# has second resolution, so it's rebuilt at most once a second
+_time_cache = (None, b'')
+
 @app.route('/get_current_time', methods=['GET'])
 def get_current_time():
     """API endpoint to get current server time for time visualization"""
-    now = datetime.now()
-    return jsonify({
-        'success': True,
-        'time': {
-            'hours': now.hour,
-            'minutes': now.minute,
-            'seconds': now.second,
-            'total_minutes': now.hour * 60 + now.minute,
-            'iso_string': now.isoformat()
-        }
-    })
+    global _time_cache
+    second, body = _time_cache
+    if second != int(time.time()):
+        now = datetime.now()
+        body = orjson.dumps({
+            'success': True,
+            'time': {
+                'hours': now.hour,
+                'minutes': now.minute,
+                'seconds': now.second,
+                'total_minutes': now.hour * 60 + now.minute,
+                'iso_string': now.isoformat()
+            }
+        })
+        _time_cache = (int(now.timestamp()), body)
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/extract_booking', methods=['POST'])
 def extract_booking():
@@ -299,19 +816,30 @@ def extract_booking():
     if not slot_key:
         return jsonify({'success': False, 'error': 'Missing slot_key'})
     
-    if slot_key not in bookings:
-        return jsonify({'success': False, 'error': 'Booking not found'})
+    # The client identifies the slot by its "date_time" key
+    try:
+        date_str, time_str = _parse_slot_key(slot_key)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid slot_key'})
+    with _date_locks[date_str]:
+        if is_past_date(date_str):
+            return jsonify({'success': False, 'error': 'Bookings for past dates cannot be changed'})
+        
+        booking = bookings.get(date_str, {}).get(time_str)
+    
+        if booking is None:
+            return jsonify({'success': False, 'error': 'Booking not found'})
     
-    # Extract booking to CSV
-    booking = bookings[slot_key]
-    csv_result = extract_booking_to_csv(slot_key, booking, reason)
+        # Write the CSV row now and only drop the booking once it is on disk,
+        # so a failed write leaves the booking in place for a retry
+        result = extract_booking_to_csv(date_str, time_str, booking, reason)
+        if not result['success']:
+            return jsonify({'success': False, 'error': f"Failed to write CSV: {result['error']}"})
     
-    # Remove booking from memory after successful extraction
-    if csv_result['success']:
-        del bookings[slot_key]
-        save_bookings()
+        _remove_booking(date_str, time_str)
+        queue_booking_op('del', date_str, time_str)
     
-    return jsonify(csv_result)
+    return jsonify(result)
 
 @app.route('/get_server_date')
 def get_server_date():
@@ -319,6 +847,16 @@ def get_server_date():
     current_date = datetime.now().strftime('%Y-%m-%d')
     return jsonify({'date': current_date})
 
+@app.route('/healthz')
+def healthz():
+    """Aggregate health check covering the main subsystems in one request"""
+    checks = {
+        'bookings': _bookings_loaded,
+        'writer': _writer_thread.is_alive(),
+    }
+    ok = all(checks.values())
+    return jsonify({'ok': ok, 'checks': checks, 'pending_writes': write_queue.qsize()}), 200 if ok else 503
+
 @app.route('/admin')
 def admin_page():
     """Admin page with password protection"""
@@ -335,7 +873,8 @@ def verify_admin_password():
     data = request.get_json()
     password = data.get('password', '').strip()
     
-    if password == ADMIN_PASSWORD:
+    # Constant-time comparison so response timing doesn't leak how much of the password matched
+    if hmac.compare_digest(password.encode('utf-8'), _ADMIN_PASSWORD_BYTES):
         return jsonify({'success': True, 'message': 'Admin access granted'})
     else:
         return jsonify({'success': False, 'message': 'Invalid admin password'})
@@ -345,24 +884,25 @@ def download_csv():
     """Download CSV files - list available CSV files"""
     try:
         csv_files = []
-        for filename in os.listdir('.'):
-            if filename.startswith('bookings_') and filename.endswith('.csv'):
-                file_path = os.path.join('.', filename)
-                file_size = os.path.getsize(file_path)
-                file_date = os.path.getmtime(file_path)
+        # scandir entries carry their own stat result, so one stat per file
+        with os.scandir('.') as entries:
+            for entry in entries:
+                filename = entry.name
+                if not is_booking_csv(filename):
+                    continue
+                st = entry.stat()
                 
                 # Extract date from filename (bookings_YYYY-MM-DD.csv)
                 try:
-                    date_part = filename.replace('bookings_', '').replace('.csv', '')
-                    file_date_from_name = datetime.strptime(date_part, '%Y-%m-%d').date()
+                    file_date_from_name = date.fromisoformat(filename[len('bookings_'):-len('.csv')])
                 except ValueError:
                     # If date parsing fails, use a very old date as fallback
-                    file_date_from_name = datetime(1900, 1, 1).date()
+                    file_date_from_name = date(1900, 1, 1)
                 
                 csv_files.append({
                     'filename': filename,
-                    'size': file_size,
-                    'date': datetime.fromtimestamp(file_date).strftime('%Y-%m-%d %H:%M:%S'),
+                    'size': st.st_size,
+                    'date': datetime.fromtimestamp(st.st_mtime).isoformat(sep=' ', timespec='seconds'),
                     'sort_date': file_date_from_name
                 })
         
@@ -371,24 +911,24 @@ def download_csv():
         
         return jsonify({'success': True, 'files': csv_files})
     except Exception as e:
-        logger.error(f"Error listing CSV files: {e}")
+        logger.error("Error listing CSV files: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/admin/download_csv/<filename>')
 def download_specific_csv(filename):
     """Download a specific CSV file"""
     try:
-        # Security check - only allow CSV files that start with 'bookings_'
-        if not filename.startswith('bookings_') or not filename.endswith('.csv'):
+        # Security check - only allow bookings_YYYY-MM-DD.csv files in the app directory
+        if not is_booking_csv(filename):
             return jsonify({'success': False, 'error': 'Invalid file type'})
         
+        # send_file stats the file itself and answers conditional requests with a 304
         file_path = os.path.join('.', filename)
-        if not os.path.exists(file_path):
-            return jsonify({'success': False, 'error': 'File not found'})
-        
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        return send_file(file_path, as_attachment=True, download_name=filename, conditional=True)
+    except FileNotFoundError:
+        return jsonify({'success': False, 'error': 'File not found'})
     except Exception as e:
-        logger.error(f"Error downloading CSV file {filename}: {e}")
+        logger.error("Error downloading CSV file %s: %s", filename, e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/admin/download_bad_words')
@@ -396,13 +936,11 @@ def download_bad_words():
     """Download the bad_words.txt file"""
     try:
         file_path = os.path.join('.', 'bad_words.txt')
-        
-        if not os.path.exists(file_path):
-            return jsonify({'success': False, 'error': 'Bad words file not found'})
-        
-        return send_file(file_path, as_attachment=True, download_name='bad_words.txt')
+        return send_file(file_path, as_attachment=True, download_name='bad_words.txt', conditional=True)
+    except FileNotFoundError:
+        return jsonify({'success': False, 'error': 'Bad words file not found'})
     except Exception as e:
-        logger.error(f"Error downloading bad_words.txt: {e}")
+        logger.error("Error downloading bad_words.txt: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/admin/upload_display_names', methods=['POST'])
@@ -419,11 +957,13 @@ def upload_display_names():
         if file.filename != 'display_name.txt':
             return jsonify({'success': False, 'error': 'File must be named display_name.txt'})
         
-        # Save the uploaded file
-        file.save('display_name.txt')
-        
-        # Reload display names
-        load_display_names()
+        # Parse the upload directly, then save it (no re-read from disk)
+        data = file.read()
+        names = parse_display_names(data.decode('utf-8'))
+        with open('display_name.txt', 'wb') as f:
+            f.write(data)
+        set_display_names(names)
+        logger.info("Loaded %d display names", len(names))
         
         return jsonify({
             'success': True, 
@@ -432,7 +972,7 @@ def upload_display_names():
             'refresh_required': True  # Signal that client should refresh type-ahead
         })
     except Exception as e:
-        logger.error(f"Error uploading display names: {e}")
+        logger.error("Error uploading display names: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/admin/upload_bad_words', methods=['POST'])
@@ -455,7 +995,8 @@ def upload_bad_words():
         # Count the number of bad words loaded
         try:
             with open('bad_words.txt', 'r', encoding='utf-8') as f:
-                bad_words_count = len([line.strip() for line in f if line.strip() and not line.strip().startswith('#')])
+                bad_words_count = sum(1 for word in map(str.strip, f.read().splitlines())
+                                      if word and not word.startswith('#'))
         except:
             bad_words_count = 0
         
@@ -466,29 +1007,34 @@ def upload_bad_words():
             'refresh_required': True  # Signal that client should refresh bad words
         })
     except Exception as e:
-        logger.error(f"Error uploading bad words: {e}")
+        logger.error("Error uploading bad words: %s", e)
         return jsonify({'success': False, 'error': str(e)})
 
 @app.route('/admin/delete_csv/<filename>', methods=['DELETE'])
 def delete_csv(filename):
     """Delete a specific CSV file"""
     try:
-        # Security check - only allow CSV files that start with 'bookings_'
-        if not filename.startswith('bookings_') or not filename.endswith('.csv'):
+        # Security check - only allow bookings_YYYY-MM-DD.csv files in the app directory
+        if not is_booking_csv(filename):
             return jsonify({'success': False, 'error': 'Invalid file type'})
         
         file_path = os.path.join('.', filename)
-        if not os.path.exists(file_path):
-            return jsonify({'success': False, 'error': 'File not found'})
         
-        # Delete the file
-        os.remove(file_path)
-        logger.info(f"Deleted CSV file: {filename}")
+        # Delete the file (dropping any handle the CSV writer still holds on it)
+        with _csv_lock:
+            close_csv_file(filename)
+            os.remove(file_path)
+        logger.info("Deleted CSV file: %s", filename)
         
         return jsonify({'success': True, 'message': f'File "{filename}" deleted successfully'})
+    except FileNotFoundError:
+        return jsonify({'success': False, 'error': 'File not found'})
     except Exception as e:
-        logger.error(f"Error deleting CSV file {filename}: {e}")
+        logger.error("Error deleting CSV file %s: %s", filename, e)
         return jsonify({'success': False, 'error': str(e)})
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server only (see wsgi.py for production). Debug mode is opt-in:
+    # the debugger must never be exposed on 0.0.0.0 by default. Its reloader
+    # parent skips start_bookings() above, so only the serving child owns the data.
+    app.run(debug=DEBUG, host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,12 @@
+"""WSGI entry point for running TechCafe under a production server:
+
+    gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:app
+
+Keep a single worker process: bookings live in process memory and are
+persisted by one background writer thread, so extra workers would each see
+their own copy. Scale with --threads instead.
+"""
+from app import app
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)